@@ -2,13 +2,14 @@
 # 2023-12-12
 
 
+import micropython
 from array import array
-from math import ceil, floor
-from utime import sleep_ms
+from utime import sleep_ms, sleep_us, ticks_add, ticks_diff, ticks_ms, ticks_us
 from machine import Pin
-from rp2 import PIO, StateMachine, asm_pio
-from random import choice, randint, uniform
-from time import time
+from os import urandom
+from rp2 import DMA, PIO, StateMachine, asm_pio
+from random import choice, randint
+from uctypes import addressof
 
 
 
@@ -26,6 +27,32 @@ VISIBLE_LEDS = 288
 # the end nicely)
 OVERSCAN_LEDS = 10
 
+# time to hold the data line low after sending a frame, so the LEDs latch
+# it (us)
+LATCH_US = 300
+
+# frequency the ws2812 StateMachine runs at (Hz) and the number of cycles
+# its program takes to send each bit (T1 + T2 + T3 in ws2812())
+WS2812_FREQ = 8000000
+WS2812_CYCLES_PER_BIT = 10
+
+# time taken to send each bit to the strip (ns) - this is worked out
+# without going through 10^9, which is too big for a small integer
+BIT_NS = WS2812_CYCLES_PER_BIT * 1000000 // (WS2812_FREQ // 1000)
+
+
+
+# PIO AND DMA
+
+
+# address of the TX FIFO for state machine 0 on PIO0 (the others follow
+# on, 4 bytes apart)
+PIO0_TXF0 = 0x50200010
+
+# DMA transfer request signal for the TX FIFO of state machine 0 on PIO0
+# (the others follow on, incrementing by 1)
+DREQ_PIO0_TX0 = 0
+
 
 
 # LED INDICATORS
@@ -52,11 +79,15 @@ MAX_TIME = 20
 
 
 @asm_pio(sideset_init=PIO.OUT_LOW, out_shiftdir=PIO.SHIFT_LEFT, autopull=True,
-         pull_thresh=24)
+         pull_thresh=32)
 
 def ws2812():
     """Programmed IO (PIO) function for signalling WS2812 Neopixel strip
     over SPI bus.
+
+    The colours are sent as a continuous stream of bits, MSB first, using
+    all 32 bits of each word, so 4 colours are packed into 3 words (see
+    _pack_grb24()).
     """
 
     # timings for various steps
@@ -103,14 +134,323 @@ def grb_list(grbs):
 
 
 
-def color_at_luma(color, luma):
+@micropython.viper
+def color_at_luma(color: int, luma: int) -> int:
     """Return a colour value (in GRB or RGB format) with the brightness
     scaled to the specified luma value in the range 0-255.
     """
 
-    return ((int((color & 0xff0000) * luma // 255) & 0xff0000)
-            | (int((color & 0xff00) * luma // 255) & 0xff00)
-            | (int((color & 0xff) * luma // 255) & 0xff))
+    # stretch the luma to 0-256 so we can scale each channel with a
+    # shift, rather than dividing by 255
+    luma += luma >> 7
+
+    return (((((color >> 16) & 0xff) * luma) >> 8) << 16
+            | ((((color >> 8) & 0xff) * luma) >> 8) << 8
+            | (((color & 0xff) * luma) >> 8))
+
+
+
+@micropython.viper
+def _fill_luma_table(lut: ptr8, color: int):
+    """Fill in a 256-entry array("I") with the colour at each luma, as
+    for color_at_luma().  The table is written a channel at a time
+    through a byte pointer: the words are little-endian, so byte 0 of
+    each is blue, then red, then green.
+    """
+
+    g = (color >> 16) & 0xff
+    r = (color >> 8) & 0xff
+    b = color & 0xff
+
+    i = 0
+    for luma in range(256):
+        scale = luma + (luma >> 7)
+        lut[i] = (b * scale) >> 8
+        lut[i + 1] = (r * scale) >> 8
+        lut[i + 2] = (g * scale) >> 8
+        i += 4
+
+
+
+_luma_tables = {}
+
+
+def luma_table(color):
+    """Return a 256-entry array giving the colour at each luma value.
+    This is used to look up colours in the render loops rather than
+    scaling them for every LED.
+
+    The colours come from small palettes, so the tables are cached and
+    shared between everything using the same colour: they must not be
+    modified.  The colour fits in a small integer, so looking a table
+    up allocates nothing.
+    """
+
+    lut = _luma_tables.get(color)
+    if lut is None:
+        lut = array("I", [0 for _ in range(256)])
+        _fill_luma_table(lut, color)
+        _luma_tables[color] = lut
+    return lut
+
+
+
+def falloff_scale(half):
+    """Return the scale used to convert the square of the distance in
+    from the edge of something with the specified half-width into a luma
+    (0-255), with a multiply and a shift right by 16 bits, rather than a
+    division.  This is rounded up, so the centre is at full brightness.
+    """
+
+    half_sq = half * half
+    return ((255 << 16) + half_sq - 1) // half_sq
+
+
+
+@micropython.viper
+def falloff_luma(half: int, scale: int, distance: int) -> int:
+    """Return the luma (0-255) for a point at the specified distance
+    from the centre of something with the specified half-width (and
+    falloff scale from falloff_scale()).  The intensity falls off with
+    the square of the distance, reaching zero at the edge.
+    """
+
+    if distance >= half:
+        return 0
+    diff = half - distance
+    return (diff * diff * scale) >> 16
+
+
+
+def falloff_table(color, half, brightness=255):
+    """Return an array giving the colour at each distance from the
+    centre of something with the specified half-width, with the falloff
+    and brightness both applied, so rendering it is just a lookup for
+    each LED.
+    """
+
+    table = array("I", [0 for _ in range(max(half, 1))])
+    scale = falloff_scale(half)
+    for distance in range(half):
+        luma = falloff_luma(half, scale, distance)
+        table[distance] = color_at_luma(color, brightness * luma // 255)
+    return table
+
+
+
+@micropython.viper
+def _render_trains(buf: ptr32, lo: int, hi: int, n: int, pos: ptr32,
+                   half: ptr32, tables: ptr32):
+    """Add n trains into LEDs lo to hi-1 of a display buffer.  The
+    parameters for each train are given in the same entry of the
+    remaining arrays: the centre position (in fixed point, with 8
+    fractional bits), half-width and the address of a table of the
+    train colour at each distance from the centre (see falloff_table()).
+    """
+
+    for train in range(n):
+        p = pos[train] >> 8
+        h = half[train]
+        table = ptr32(tables[train])
+
+        first = p - h
+        if first < lo:
+            first = lo
+        last = p + h
+        if last > hi:
+            last = hi
+
+        for led in range(first, last):
+            distance = p - led
+            if distance < 0:
+                distance = -distance
+            if distance < h:
+                # add the colour, saturating each channel at 255 rather
+                # than overflowing into the next: the bottom 7 bits of
+                # each channel are added, so bit 7 is the carry into it,
+                # then bit 7 is fixed up and (carry >> 7) * 0xff sets the
+                # channels which carried out to 255
+                a = buf[led]
+                b = table[distance]
+                low = (a & 0x7f7f7f) + (b & 0x7f7f7f)
+                carry = ((a & b) | ((a | b) & low)) & 0x808080
+                buf[led] = (low ^ ((a ^ b) & 0x808080)) | ((carry >> 7) * 0xff)
+
+
+
+@micropython.viper
+def _move_trains(pos: ptr32, speed: ptr32, half: ptr32, tables: ptr32,
+                 n: int, last: int) -> int:
+    """Move n trains, stored as for _render_trains(), on by their speeds
+    (in the same fixed point as the positions) and remove any which
+    have gone beyond LED last, moving the remaining ones down the arrays
+    to fill the gaps.  The new number of trains is returned.
+    """
+
+    keep = 0
+    for train in range(n):
+        p = pos[train] + speed[train]
+        if (p >> 8) - half[train] <= last:
+            pos[keep] = p
+            speed[keep] = speed[train]
+            half[keep] = half[train]
+            tables[keep] = tables[train]
+            keep += 1
+    return keep
+
+
+
+@micropython.viper
+def _blit_drop(buf: ptr32, lo: int, hi: int, pos: int, size: int,
+               scale: int, lut: ptr32):
+    """Add a rain drop, centred on pos with the specified current size
+    and falloff scale for its maximum size, into a display buffer,
+    splashing out symmetrically either side, but only into LEDs lo to
+    hi-1.  The colour is taken from a 256-entry table of the drop colour
+    at each luma.
+    """
+
+    for offset in range(0, size - 1):
+        diff = size - offset
+        b = lut[(diff * diff * scale) >> 16]
+
+        # add the colour either side, saturating each channel (see
+        # _render_trains() for how this works)
+        led = pos - offset
+        if (led >= lo) and (led < hi):
+            a = buf[led]
+            low = (a & 0x7f7f7f) + (b & 0x7f7f7f)
+            carry = ((a & b) | ((a | b) & low)) & 0x808080
+            buf[led] = (low ^ ((a ^ b) & 0x808080)) | ((carry >> 7) * 0xff)
+
+        # the centre is only added once
+        led = pos + offset
+        if (offset > 0) and (led >= lo) and (led < hi):
+            a = buf[led]
+            low = (a & 0x7f7f7f) + (b & 0x7f7f7f)
+            carry = ((a & b) | ((a | b) & low)) & 0x808080
+            buf[led] = (low ^ ((a ^ b) & 0x808080)) | ((carry >> 7) * 0xff)
+
+
+
+@micropython.viper
+def _fill(buf: ptr32, start: int, end: int, color: int):
+    "Set entries start to end-1 of a display buffer to a colour."
+
+    for i in range(start, end):
+        buf[i] = color
+
+
+
+# the state for _random_bits(), seeded from the hardware random number
+# generator - this must never be zero
+_random_state = array("I", [int.from_bytes(urandom(4), "little") | 1])
+
+
+@micropython.viper
+def _random_bits(state: ptr32) -> int:
+    """Step the xorshift32 generator with its state in the first entry
+    of the array and return 24 random bits.  This is much cheaper than
+    calling the random module in the animation loops and allocates
+    nothing.
+    """
+
+    s = uint(state[0])
+    s ^= s << 13
+    s ^= s >> 17
+    s ^= s << 5
+    state[0] = s
+
+    # only return the top 24 bits, so the result is always a small,
+    # positive integer
+    return int(s >> 8)
+
+
+
+def random_byte():
+    "Return a random number 0-255."
+
+    return _random_bits(_random_state) & 0xff
+
+
+
+def random_pct():
+    """Return a random percentage 1-100, for use like randint(1, 100),
+    using a single random byte.
+    """
+
+    return ((random_byte() * 100) >> 8) + 1
+
+
+
+def random_int(a, b):
+    """Return a random integer in the range a-b (inclusive), for use
+    like randint(a, b).  The range must be no more than 65536.
+    """
+
+    return a + (_random_bits(_random_state) & 0xffff) % (b - a + 1)
+
+
+
+def random_choice(seq):
+    "Return a random element from a sequence, for use like choice(seq)."
+
+    return seq[random_byte() % len(seq)]
+
+
+
+@micropython.viper
+def _pack_grb24(dst: ptr32, src: ptr32, n: int, clear: int) -> int:
+    """Pack n colours in 0GRB format from src into dst as a continuous
+    stream of 24-bit values, as the ws2812 PIO program takes them, so 4
+    colours take up 3 words.  Any bits left over at the end are zero.
+    The number of words written is returned.
+
+    If clear is true, src is set to black as it is read, saving a
+    separate pass over it to clear it before the next frame.
+    """
+
+    i = 0
+    w = 0
+    while i + 4 <= n:
+        a = src[i]
+        b = src[i + 1]
+        c = src[i + 2]
+        dst[w] = (a << 8) | (b >> 16)
+        dst[w + 1] = (b << 16) | (c >> 8)
+        dst[w + 2] = (c << 24) | src[i + 3]
+        if clear:
+            src[i] = 0
+            src[i + 1] = 0
+            src[i + 2] = 0
+            src[i + 3] = 0
+        i += 4
+        w += 3
+
+    # pack any remaining 1-3 colours
+    left = n - i
+    if left > 0:
+        a = src[i]
+        b = 0
+        c = 0
+        if left > 1:
+            b = src[i + 1]
+        if left > 2:
+            c = src[i + 2]
+        dst[w] = (a << 8) | (b >> 16)
+        w += 1
+        if left > 1:
+            dst[w] = (b << 16) | (c >> 8)
+            w += 1
+        if left > 2:
+            dst[w] = c << 24
+            w += 1
+        if clear:
+            while i < n:
+                src[i] = 0
+                i += 1
+
+    return w
 
 
 
@@ -118,6 +458,74 @@ def color_at_luma(color, luma):
 
 
 
+class NeopixelDMA(object):
+    """Feeds a StateMachine on PIO0 running the ws2812 program using DMA,
+    so the next frame can be rendered whilst the current one is being
+    sent to the strip.  The effects are given this in place of the
+    StateMachine and call put() on it with the colours to display.
+
+    Two transmit buffers are used in turn: each frame is packed into the
+    one not being sent, so the effect can carry on changing its display
+    buffer straight away.
+    """
+
+    def __init__(self, sm, sm_id=0, leds=VISIBLE_LEDS):
+        self._sm = sm
+        self._dma = DMA()
+        self._ctrl = self._dma.pack_ctrl(
+            size=2, inc_write=False, treq_sel=DREQ_PIO0_TX0 + sm_id)
+        self._fifo = PIO0_TXF0 + sm_id * 4
+        self._tx = [array("I", [0 for _ in range((leds * 3 + 3) // 4)])
+                        for _ in range(2)]
+        self._next_tx = 0
+        self._latched_at = ticks_us()
+
+    def wait(self):
+        """Wait for the frame being sent to finish and be latched.  This
+        only sleeps for whatever is left of that time, so it doesn't
+        wait at all if the effect took longer than that to get to the
+        next frame.
+        """
+
+        delay = ticks_diff(self._latched_at, ticks_us())
+        if delay > 0:
+            sleep_us(delay)
+
+        # the frame should have been sent by now, but make sure the DMA
+        # channel isn't reconfigured while it's still running and, if
+        # the StateMachine is still sending, wait for it to finish and
+        # latch, in case the timing is ever out
+        while self._dma.active():
+            pass
+        if self._sm.tx_fifo():
+            while self._sm.tx_fifo():
+                pass
+            sleep_us(LATCH_US)
+
+    def put(self, buf, clear=False):
+        """Start sending the colours in buf, in 0GRB format, to the
+        StateMachine.  This returns without waiting for the transfer to
+        complete, unless the previous one is still in progress.
+
+        If clear is True, buf is set to black once it has been copied.
+        """
+
+        tx = self._tx[self._next_tx]
+        words = _pack_grb24(tx, buf, len(buf), clear)
+
+        self.wait()
+        self._dma.config(read=tx, write=self._fifo, count=words,
+                         ctrl=self._ctrl, trigger=True)
+        self._next_tx ^= 1
+
+        # the time to send a frame is fixed by the number of bits, so we
+        # can work out when it will have been latched now, rather than
+        # polling the DMA and FIFO until it's finished
+        self._latched_at = ticks_add(
+            ticks_us(), words * 32 * BIT_NS // 1000 + LATCH_US)
+
+
+
 class NeopixelStrip(object):
     """Abstract class for a Neopixel strip.
     """
@@ -126,12 +534,31 @@ class NeopixelStrip(object):
                  brightness=BRIGHTNESS):
         self._sm = sm
         self._leds = leds
+
+        # the brightness is fixed for an effect, so effects which use it
+        # (trains and stripes) apply it to their colours when they are
+        # set up (e.g. in colour tables), rather than scaling anything as
+        # each frame is rendered - rain and stars don't currently apply
+        # it and use their colours at full brightness
         self._brightness = brightness
+
         self._min = overscan
         self._max = leds + overscan
         self._len = leds + overscan * 2
         self._display = array("I", [0 for _ in range(self._len)])
 
+        # slicing a memoryview doesn't copy the underlying buffer, unlike
+        # slicing the array, so we use this to pass to the StateMachine -
+        # the visible part is sliced once here, as even a memoryview
+        # slice allocates a new object
+        self._display_mv = memoryview(self._display)
+        self._visible_mv = self._display_mv[self._min:self._max]
+
+        # effects which redraw everything each frame set this to have
+        # the visible part of the display buffer cleared as it is sent,
+        # rather than clearing it separately before rendering
+        self._clear_on_display = False
+
     def __repr__(self):
         "Method for debugging to print out the strip effect type."
         print("NeopixelStrip()")
@@ -145,8 +572,7 @@ class NeopixelStrip(object):
     def clear(self, color=0):
         "Clear the display buffer to a particular color, default black."
 
-        for pos in range(self._min, self._max + 1):
-            self._display[pos] = color
+        _fill(self._display, self._min, self._max + 1, color)
 
     def render(self):
         "Renders the current state of the effect into the display buffer."
@@ -177,7 +603,7 @@ class NeopixelStrip(object):
 
     def display(self):
         "Render the current display buffer onto the Neopixel strip."
-        self._sm.put(self._display[self._min:self._max], 8)
+        self._sm.put(self._visible_mv, clear=self._clear_on_display)
 
     def cycle(self):
         """Process a complete frame cycle of the effect: render it,
@@ -208,40 +634,10 @@ class NeopixelPoint(object):
 
 
 MAX_TRAINS = 4
-TRAIN_FALLOFF = 2
 NEW_TRAIN_PROBABILITY_PCT = 80
 TRAIN_WIDTH_MIN = 8
 TRAIN_WIDTH_MAX = 24
-
-
-
-class Train(object):
-    def __init__(self, rgb, width=4, speed=1, pos=0):
-        self._rgb = rgb
-        self._halfwidth = width // 2
-        self._speed = speed
-        self._pos = pos
-
-    def __repr__(self):
-        return ("Train(color=%s, pos=%d, halfwidth=%d)"
-                    % (grb_to_hex(self._rgb), self._pos, self._halfwidth))
-
-    def move(self):
-        self._pos += self._speed
-
-    def color_at(self, p):
-        distance = abs(int(self._pos) - p)
-        if distance > self._halfwidth:
-            return 0    # =BLACK
-        intensity = int(((max(self._halfwidth - distance, 0) / self._halfwidth)
-                         ** TRAIN_FALLOFF) * 255)
-        return color_at_luma(self._rgb, intensity)
-
-    def min(self):
-        return self._pos - self._halfwidth
-
-    def max(self):
-        return self._pos + self._halfwidth
+TRAIN_SPEEDS = (0.5, 1, 2)
 
 
 
@@ -256,46 +652,97 @@ class NeopixelTrains(NeopixelStrip):
         self._colors = colors
         self._max_trains = max_trains
 
+        # the trains are stored in these arrays, with each train in the
+        # same entry of each, so they can all be moved and rendered with
+        # single calls to _move_trains() and _render_trains() - the
+        # position and speed are in fixed point, with 8 fractional bits,
+        # so fractional speeds don't need floats
+        self._train_pos = array("i", [0 for _ in range(max_trains)])
+        self._train_speed = array("i", [0 for _ in range(max_trains)])
+        self._train_half = array("i", [0 for _ in range(max_trains)])
+        self._train_table = array("I", [0 for _ in range(max_trains)])
+        self._num_trains = 0
+
+        # the colour tables for the trains, keyed on colour and
+        # half-width - these are shared between trains and referenced
+        # from the arrays above by address, so must be kept here
+        #
+        # the colours, widths and brightness are all fixed for the
+        # effect, so we build every table here, rather than when a train
+        # is added
+        self._tables = {}
+        for color in colors:
+            for width in range(TRAIN_WIDTH_MIN, TRAIN_WIDTH_MAX + 1):
+                self._table(color, width // 2)
+
+        # the trains only draw over the LEDs they cover but clearing the
+        # buffer as it is packed for sending is just one extra store per
+        # LED, so that's cheaper than tracking the spans drawn on
+        self._clear_on_display = True
+
     def __repr__(self):
         return f"NeopixelTrains(colors={grb_list(self._colors)})"
 
     def reinit(self):
         super().reinit()
-        self._trains = []
+        self._num_trains = 0
 
     def is_finished(self):
-        return len(self._trains) == 0
+        return self._num_trains == 0
 
     def render(self):
-        for led in range(0, self._len):
-            self._display[led] = 0
-
-        for train in self._trains:
-            for led in range(max(floor(train.min()), 0),
-                             min(ceil(train.max()), self._len - 1)):
-                self._display[led] |= (
-                    color_at_luma(train.color_at(led), self._brightness))
+        # the display buffer was cleared when the last frame was sent, so
+        # we only need to add the trains - these are only drawn into the
+        # visible part, so that stays clear
+        _render_trains(self._display, self._min, self._max,
+                       self._num_trains, self._train_pos, self._train_half,
+                       self._train_table)
 
     def move(self):
-        # move the trains
-        for train in self._trains:
-            train.move()
-
-        # if a train has reached the end, remove it
-        self._trains = [train for train in self._trains
-                            if train.min() <= self._max]
+        # move the trains and remove any which have reached the end -
+        # trains move at different speeds and can overtake, so the
+        # oldest isn't always the first to leave and we check them all
+        self._num_trains = _move_trains(
+            self._train_pos, self._train_speed, self._train_half,
+            self._train_table, self._num_trains, self._max)
 
         # if we have fewer than the maximum number of trains and not expired...
-        if (not self._expired) and (self.num_trains() < self._max_trains):
+        if (not self._expired) and (self._num_trains < self._max_trains):
             # ... there's a 2 in 11 chance we create a new train
-            if randint(1, 100) <= NEW_TRAIN_PROBABILITY_PCT:
-                width = randint(TRAIN_WIDTH_MIN, TRAIN_WIDTH_MAX)
-                self._trains.append(Train(choice(self._colors), width=width,
-                                          speed=choice([0.5, 1, 2]),
-                                          pos=-width // 2))
+            if random_pct() <= NEW_TRAIN_PROBABILITY_PCT:
+                width = random_int(TRAIN_WIDTH_MIN, TRAIN_WIDTH_MAX)
+                self.add_train(random_choice(self._colors), width,
+                               random_choice(TRAIN_SPEEDS))
+
+    def add_train(self, color, width, speed):
+        "Add a new train, just off the start of the strip."
+
+        half = width // 2
+
+        n = self._num_trains
+        self._train_pos[n] = (-width // 2) << 8
+        self._train_speed[n] = int(speed * 256)
+        self._train_half[n] = half
+        self._train_table[n] = addressof(self._table(color, half))
+        self._num_trains = n + 1
+
+    def _table(self, color, half):
+        """Return the colour table for a train of the specified colour
+        and half-width, building it if it's not already been done.
+        """
+
+        # the colour only uses the bottom 24 bits, so the half-width can
+        # go above it to make the key
+        key = color | (half << 24)
+
+        table = self._tables.get(key)
+        if table is None:
+            table = falloff_table(color, half, self._brightness)
+            self._tables[key] = table
+        return table
 
     def num_trains(self):
-        return len(self._trains)
+        return self._num_trains
 
 
 
@@ -319,6 +766,12 @@ class NeopixelStripes(NeopixelStrip):
         super().__init__(sm, **kwargs)
         self._color1 = color1
         self._color2 = color2
+
+        # the brightness is fixed for the effect, so scale the colours
+        # once here, rather than every time the pattern is built
+        self._scaled_color1 = color_at_luma(color1, self._brightness)
+        self._scaled_color2 = color_at_luma(color2, self._brightness)
+
         self._init_width = width
         self._init_wait = wait
 
@@ -332,23 +785,36 @@ class NeopixelStripes(NeopixelStrip):
             self._init_width or randint(STRIPES_WIDTH_MIN, STRIPES_WIDTH_MAX))
         self._wait = (
             self._init_wait or randint(STRIPES_WAIT_MIN, STRIPES_WAIT_MAX))
-        self._offset = 0
-        for led in range(0, self._len):
-            self._display[led] = self._next_color()
-
-    def _next_color(self):
-        if self._offset < self._width:
-            color = color_at_luma(self._color1, self._brightness)
-        else:
-            color = color_at_luma(self._color2, self._brightness)
-        self._offset += 1
-        if self._offset >= self._width * 2:
-            self._offset = 0
-        return color
+
+        # the stripes repeat every two widths (a period), so we build the
+        # pattern long enough to cover the strip from any point in the
+        # first period and then just track where we are in it
+        self._period = self._width * 2
+        self._pattern = array(
+            "I", (([self._scaled_color1] * self._width
+                   + [self._scaled_color2] * self._width)
+                  * (self._len // self._period + 2)))
+        self._phase = 0
+
+        # slice the visible part of the pattern for each phase up front,
+        # so displaying a frame doesn't allocate anything
+        pattern_mv = memoryview(self._pattern)
+        self._phase_mvs = []
+        for phase in range(self._period):
+            start = (self._min + phase) % self._period
+            self._phase_mvs.append(pattern_mv[start:start + self._leds])
 
     def move(self):
-        self._display[:-1] = self._display[1:]
-        self._display[-1] = self._next_color()
+        # moving the stripes just steps the phase through the pattern -
+        # nothing is copied or shifted along the strip
+        phase = self._phase + 1
+        self._phase = phase if phase < self._period else 0
+
+    def display(self):
+        # send the visible part straight from the pattern, starting from
+        # the current phase, rather than copying it into the display
+        # buffer first
+        self._sm.put(self._phase_mvs[self._phase])
 
     def wait(self):
         sleep_ms(self._wait)
@@ -369,9 +835,22 @@ class RainDrop(NeopixelPoint):
     "Class for representing a coloured raindrop splashing."
 
 
-    def __init__(self, pos, color, max_size):
+    def __init__(self, pos=0, color=None, max_size=RAIN_MAX_SIZE):
         super().__init__(pos, color)
+        self.reset(pos, color, max_size)
+
+
+    def reset(self, pos, color, max_size):
+        # set up the drop as new, reusing the existing object, so drops
+        # can be pooled
+        self.pos = pos
+        self.color = color
         self.max_size = max_size
+        self._falloff_scale = falloff_scale(max_size)
+
+        # drops made for the pool have no colour until they're spawned,
+        # so don't build (and cache) a colour table for them
+        self._lut = None if color is None else luma_table(color)
 
         self.current_size = 0
         self.target_size = self.max_size
@@ -403,10 +882,10 @@ class RainDrop(NeopixelPoint):
         return (self.current_size == 0) and (self.target_size == 0)
 
 
-    def color_at_offset(self, offset):
-        intensity = int(((max(self.current_size - offset, 0) / self.max_size)
-                    ** TRAIN_FALLOFF) * 255)
-        return color_at_luma(self.color, intensity)
+    def render(self, display, lo, hi):
+        "Add this drop into the display buffer, within LEDs lo to hi-1."
+        _blit_drop(display, lo, hi, self.pos, self.current_size,
+                   self._falloff_scale, self._lut)
 
 
 class NeopixelRain(NeopixelStrip):
@@ -418,42 +897,64 @@ class NeopixelRain(NeopixelStrip):
         super().__init__(sm, *args, **kwargs)
         self._colors = colors
 
+        # drops are taken from this pool when created and returned to it
+        # when finished, rather than being allocated each time
+        self._free_drops = [RainDrop() for _ in range(RAIN_MAX_DROPS)]
+        self._drops = []
+
+        self._clear_on_display = True
+
     def __repr__(self):
         return f"NeopixelRain({grb_list(self._colors)})"
 
     def reinit(self):
         super().reinit()
-        self._drops = []
+        while self._drops:
+            self._free_drops.append(self._drops.pop())
 
+    @micropython.native
     def move(self):
-        # animate the drops we have
-        for drop in self._drops:
+        # look these up once, rather than for every drop
+        drops = self._drops
+        free_drops = self._free_drops
+
+        # animate the drops we have and return any that have finished to
+        # the pool, moving the remaining ones down the list to fill the
+        # gaps
+        keep = 0
+        for drop in drops:
             drop.move()
-
-        # remove any drops that have finished
-        self._drops = [ d for d in self._drops if not d.finished() ]
+            if drop.finished():
+                free_drops.append(drop)
+            else:
+                drops[keep] = drop
+                keep += 1
+        del drops[keep:]
 
         # if we have fewer than max drops, add one if not expired
         if ((not self._expired)
             and (len(self._drops) < RAIN_MAX_DROPS)
-            and (randint(1, 100) < NEW_RAIN_DROP_PCT)):
+            and (random_pct() < NEW_RAIN_DROP_PCT)):
 
-            self._drops.append(RainDrop(
-                pos=randint(self._min, self._max),
-                color=choice(self._colors),
-                max_size=randint(5, RAIN_MAX_SIZE)))
+            drop = self._free_drops.pop()
+            drop.reset(pos=random_int(self._min, self._max),
+                       color=random_choice(self._colors),
+                       max_size=random_int(5, RAIN_MAX_SIZE))
+            self._drops.append(drop)
 
+    @micropython.native
     def render(self):
-        for led in range(0, self._len):
-            self._display[led] = 0
+        # the display buffer was cleared when the last frame was sent, so
+        # we only need to add the drops, which are only drawn into the
+        # visible part
+
+        # look these up once, rather than for every LED and drop
+        display = self._display
+        lo = self._min
+        hi = self._max
 
         for drop in self._drops:
-            for offset in range(0, drop.current_size - 1):
-                color = drop.color_at_offset(offset)
-                if (drop.pos - offset) >= self._min:
-                    self._display[drop.pos - offset] |= color
-                if (drop.pos + offset) <= self._max:
-                    self._display[drop.pos + offset] |= color
+            drop.render(display, lo, hi)
 
 
     def is_finished(self):
@@ -483,6 +984,10 @@ class Star(NeopixelPoint):
     def __init__(self, pos, color):
         super().__init__(pos, color)
 
+        # the colour of the star at each luma, shared with any others
+        # of the same colour, so twinkling is just a lookup
+        self._lut = luma_table(color)
+
         # always start getting brighter
         self.luma_delta = STAR_LUMA_DELTA
 
@@ -497,7 +1002,7 @@ class Star(NeopixelPoint):
 
 
     def pos_and_color(self):
-        return self.pos, color_at_luma(self.color, self.luma)
+        return self.pos, self._lut[self.luma]
 
 
     def twinkle(self):
@@ -530,13 +1035,19 @@ class NeopixelStars(NeopixelStrip):
             self._stars.append(Star(pos=randint(self._min, self._max),
                                     color=choice(self._colors)))
 
-    def render(self):
+        # stars stay in the same place, so we only need to clear the
+        # display once - rendering then just overwrites their positions
         self.clear()
+
+    @micropython.native
+    def render(self):
+        display = self._display
         for star in self._stars:
             pos, color = star.pos_and_color()
-            self._display[pos] = color
+            display[pos] = color
 
 
+    @micropython.native
     def move(self):
         for star in self._stars:
             star.twinkle()
@@ -571,9 +1082,12 @@ DARK_GREEN = grb(0, 63, 0)
 
 
 # create the StateMachine with ws2812 program, outputting on Pin(0)
-sm = StateMachine(0, ws2812, freq=8000000, sideset_base=Pin(0))
+sm = StateMachine(0, ws2812, freq=WS2812_FREQ, sideset_base=Pin(0))
 sm.active(1)
 
+# feed the StateMachine using DMA - the effects use this in place of it
+neopixels = NeopixelDMA(sm, sm_id=0)
+
 
 TRAINS_COLORS = [
     [BLUE, WHITE, CYAN],
@@ -583,7 +1097,7 @@ TRAINS_COLORS = [
 ]
 
 trains_effects = [
-    NeopixelTrains(sm, colors=colors, brightness=191)
+    NeopixelTrains(neopixels, colors=colors, brightness=191)
         for colors in TRAINS_COLORS]
 
 
@@ -595,7 +1109,7 @@ STRIPES_COLORS = [
 ]
 
 stripes_effects = [
-    NeopixelStripes(sm, color1=c1, color2=c2, brightness=31)
+    NeopixelStripes(neopixels, color1=c1, color2=c2, brightness=31)
         for c1, c2 in STRIPES_COLORS]
 
 
@@ -607,7 +1121,7 @@ RAIN_COLORS = [
 ]
 
 rain_effects = [
-    NeopixelRain(sm, brightness=191, colors=c) for c in RAIN_COLORS]
+    NeopixelRain(neopixels, brightness=191, colors=c) for c in RAIN_COLORS]
 
 
 STARS_COLORS = [
@@ -617,7 +1131,7 @@ STARS_COLORS = [
 ]
 
 stars_effects = [
-    NeopixelStars(sm, brightness=191, colors=c) for c in STARS_COLORS]
+    NeopixelStars(neopixels, brightness=191, colors=c) for c in STARS_COLORS]
 
 
 # the strip effects we want to use are all of the ones set up
@@ -626,34 +1140,51 @@ effects = trains_effects + stripes_effects + rain_effects + stars_effects
 
 print("spi_Neopixel_Christmas starting...")
 
+# look these up once, as they're called every frame
+led_running_toggle = led_running.toggle
+led_expired_value = led_expired.value
+
 while True:
-    led_expired.value(0)
+    led_expired_value(0)
     effect = choice(effects)
     print("Displaying effect:", effect)
     effect.reinit()
     effect_time = randint(MIN_TIME, MAX_TIME)
     print("Running for %ds." % effect_time)
-    expire_at = time() + effect_time
+    expire_at = ticks_add(ticks_ms(), effect_time * 1000)
+
+    # and these, for the effect we're running
+    effect_cycle = effect.cycle
+    effect_is_finished = effect.is_finished
 
     last_remain = None
+    frame = 0
     while True:
-        remain = expire_at - time()
-
-        if remain < 0:
-            # this effect has expired - has it also finished
-            if effect.is_finished():
-                break
-            else:
-                led_expired.value(1)
-                effect.set_expired()
-
-        elif remain < 5:
-            if (last_remain is None) or (remain < last_remain):
-                # less than 5s remaining - flash the LED
-                print("Expiring in %ds." % remain)
-                led_expired.value(not remain % 2)
-                last_remain = remain
-
-        led_running.toggle()
-
-        effect.cycle()
+        # the time is only needed to the second, so just check it every
+        # few frames
+        if (frame & 3) == 0:
+            # remaining time in whole seconds (negative once expired)
+            remain = ticks_diff(expire_at, ticks_ms()) // 1000
+
+            if remain < 0:
+                # this effect has expired - has it also finished
+                if effect_is_finished():
+                    break
+                else:
+                    led_expired_value(1)
+                    effect.set_expired()
+
+            elif remain < 5:
+                if (last_remain is None) or (remain < last_remain):
+                    # less than 5s remaining - flash the LED
+                    print("Expiring in %ds." % remain)
+                    led_expired_value(not remain % 2)
+                    last_remain = remain
+
+        # toggle the running LED every few frames, rather than every one
+        if (frame & 7) == 0:
+            led_running_toggle()
+
+        frame += 1
+
+        effect_cycle()